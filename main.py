@@ -1,13 +1,15 @@
 #!/usr/bin/env python3
 """Telegram Speaker Bot - Entry point."""
 
+import asyncio
+import hashlib
 import logging
-import logging.handlers
 import os
 import signal
+import sys
 
-from telegram import BotCommand, Update
-from telegram.error import NetworkError, TimedOut
+from telegram import Bot, BotCommand, Update
+from telegram.error import NetworkError, RetryAfter, TelegramError, TimedOut
 from telegram.ext import (
     Application,
     CallbackQueryHandler,
@@ -17,125 +19,250 @@ from telegram.ext import (
 )
 from telegram.request import HTTPXRequest
 
+from modules.config import (
+    ALLOWED_USERS,
+    CONCURRENT_UPDATES,
+    SCRIPT_DIR,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET,
+    WEBHOOK_URL,
+    config,
+)
 from modules.handlers import (
     button_callback,
     connect,
     devices,
-    handle_audio,
-    handle_text,
-    handle_voice,
+    handle_message,
     help_command,
     setup,
     start,
     status,
 )
-
-# Logging configuration with rotation
-LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-LOG_DIR = os.path.dirname(os.path.abspath(__file__))
-LOG_FILE = os.path.join(LOG_DIR, "logs", "bot.log")
-
-# Ensure log directory exists
-os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
-
-# Configure root logger
-root_logger = logging.getLogger()
-root_logger.setLevel(logging.INFO)
-
-# Console handler
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
-console_handler.setFormatter(logging.Formatter(LOG_FORMAT))
-root_logger.addHandler(console_handler)
-
-# File handler with rotation (5MB per file, keep 5 backups)
-file_handler = logging.handlers.RotatingFileHandler(
-    LOG_FILE,
-    maxBytes=5 * 1024 * 1024,  # 5MB
-    backupCount=5,
-    encoding="utf-8",
+from modules.logging_setup import setup_logging
+from modules.models import DeviceType
+from modules.services import (
+    CAST_EXECUTOR,
+    DISCOVERY_EXECUTOR,
+    TTS_EXECUTOR,
+    audio_server,
+    cast_connection,
+    connect_cast,
+    remove_leftover_audio,
 )
-file_handler.setLevel(logging.INFO)
-file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
-root_logger.addHandler(file_handler)
-
-# Silence noisy library logs
-logging.getLogger("httpx").setLevel(logging.WARNING)
-logging.getLogger("httpcore").setLevel(logging.WARNING)
-logging.getLogger("pychromecast").setLevel(logging.WARNING)
-logging.getLogger("zeroconf").setLevel(logging.WARNING)
+from modules.utils import cast_discovery
+
+setup_logging()
 logger = logging.getLogger(__name__)
 
+# Long-poll timeout for getUpdates (seconds); longer polls mean fewer round-trips
+POLL_TIMEOUT = 50
+
+# Update kinds requested from Telegram; must cover every registered handler.
+# Everything else (chat member changes, polls, ...) is never sent, which keeps
+# getUpdates responses and webhook traffic small
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+# Signals that stop the bot; PTB installs them with loop.add_signal_handler,
+# so they arrive as ordinary event-loop wakeups
+STOP_SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
+# Only allowed users reach command and message handlers; checked first so
+# updates from anyone else are dropped before any other filter runs
+AUTH_FILTER = filters.User(user_id=ALLOWED_USERS)
+
+# Voice, audio and non-command text, dispatched by a single handler
+TEXT_FILTER = filters.TEXT & ~filters.COMMAND
+MESSAGE_FILTER = AUTH_FILTER & (filters.VOICE | filters.AUDIO | TEXT_FILTER)
+
+# Bot command menu
+BOT_COMMANDS = (
+    BotCommand("start", "Welcome & help"),
+    BotCommand("setup", "Configure playback device"),
+    BotCommand("connect", "Wake up & connect to device"),
+    BotCommand("status", "Show current device"),
+    BotCommand("devices", "List available devices"),
+    BotCommand("help", "Show help message"),
+)
+COMMANDS_HASH_FILE = SCRIPT_DIR / ".bot_commands_hash"
+
+# Sweep AUDIO_DIR every 10 minutes for media older than 30 minutes
+AUDIO_CLEANUP_INTERVAL = 10 * 60
+AUDIO_MAX_AGE = 30 * 60
+
+# Keep references to fire-and-forget tasks so they aren't garbage collected
+_background_tasks: set[asyncio.Task] = set()
+
+
+def run_in_background(coro) -> None:
+    """Schedule a coroutine without awaiting it."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def warm_up_cast_connection() -> None:
+    """Connect to the configured Google Cast device ahead of first use."""
+    device = config.selected_device
+    if not device or device.device_type != DeviceType.GOOGLE_CAST:
+        return
+    await connect_cast(device)
+
+
+async def clean_audio_dir() -> None:
+    """Periodically delete media that interrupted jobs left in AUDIO_DIR."""
+    while True:
+        await asyncio.sleep(AUDIO_CLEANUP_INTERVAL)
+        remove_leftover_audio(max_age=AUDIO_MAX_AGE)
+
+
+async def sync_bot_commands(bot: Bot) -> None:
+    """Set the bot command menu, skipping the call if it is unchanged."""
+    commands = [(c.command, c.description) for c in BOT_COMMANDS]
+    digest = hashlib.sha256(repr((bot.id, commands)).encode()).hexdigest()
+    if COMMANDS_HASH_FILE.exists() and COMMANDS_HASH_FILE.read_text() == digest:
+        return
+    try:
+        await bot.set_my_commands(BOT_COMMANDS)
+    except TelegramError as e:
+        logger.warning("Failed to set bot commands: %s", e)
+        return
+    COMMANDS_HASH_FILE.write_text(digest)
+
 
 def main():
     """Run the bot."""
     token = os.environ.get("TELEGRAM_BOT_TOKEN")
     if not token:
-        logger.error("TELEGRAM_BOT_TOKEN environment variable not set")
-        logger.info("Please set it with: export TELEGRAM_BOT_TOKEN='your-token-here'")
+        logger.error(
+            "TELEGRAM_BOT_TOKEN environment variable not set. "
+            "Please set it with: export TELEGRAM_BOT_TOKEN='your-token-here'"
+        )
         return
 
-    # Create application with resilient request settings
+    # Create application with resilient request settings; the pool is sized
+    # above the update concurrency so handlers never queue for a connection.
+    # Media downloads (get_file/download_to_drive) share this pool.
     request = HTTPXRequest(
+        connection_pool_size=CONCURRENT_UPDATES * 2,
         connect_timeout=10.0,
         read_timeout=30.0,
         write_timeout=30.0,
-        pool_timeout=10.0,
+        pool_timeout=20.0,
+        # HTTP/2 multiplexes concurrent edits and downloads over one connection
+        http_version="2",
     )
-    application = Application.builder().token(token).request(request).build()
-
-    # Add handlers
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("setup", setup))
-    application.add_handler(CommandHandler("connect", connect))
-    application.add_handler(CommandHandler("status", status))
-    application.add_handler(CommandHandler("devices", devices))
-    application.add_handler(CallbackQueryHandler(button_callback))
-    application.add_handler(MessageHandler(filters.VOICE, handle_voice))
-    application.add_handler(MessageHandler(filters.AUDIO, handle_audio))
-    application.add_handler(
-        MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text)
+    # Long polling gets its own pool so it never competes with outbound calls.
+    # PTB adds the long-poll timeout on top of read_timeout for getUpdates.
+    get_updates_request = HTTPXRequest(
+        connection_pool_size=1,
+        connect_timeout=10.0,
+        read_timeout=30.0,
+        write_timeout=30.0,
+        pool_timeout=20.0,
+        http_version="1.1",
+    )
+    application = (
+        Application.builder()
+        .token(token)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .request(request)
+        .get_updates_request(get_updates_request)
+        .build()
     )
 
-    # Error handler for network issues - auto-retry on transient failures
+    # Add handlers (only messages and callback queries are handled; keep
+    # ALLOWED_UPDATES in sync when registering other update kinds)
+    application.add_handler(CommandHandler("start", start, filters=AUTH_FILTER))
+    application.add_handler(CommandHandler("help", help_command, filters=AUTH_FILTER))
+    application.add_handler(CommandHandler("setup", setup, filters=AUTH_FILTER))
+    application.add_handler(CommandHandler("connect", connect, filters=AUTH_FILTER))
+    application.add_handler(CommandHandler("status", status, filters=AUTH_FILTER))
+    application.add_handler(CommandHandler("devices", devices, filters=AUTH_FILTER))
+    application.add_handler(CallbackQueryHandler(button_callback))
+    application.add_handler(MessageHandler(MESSAGE_FILTER, handle_message))
+
+    # Error handler: only logs. PTB's updater already backs off (up to 30s)
+    # when getUpdates fails, and sleeping here would only hold a handler's
+    # concurrent_updates slot without retrying anything
     async def error_handler(update: object, context) -> None:
-        if isinstance(context.error, (NetworkError, TimedOut)):
-            logger.warning(f"Network error (will auto-retry): {context.error}")
-            return  # Let polling retry automatically
-        logger.error(f"Unhandled error: {context.error}", exc_info=context.error)
+        error = context.error
+        if isinstance(error, RetryAfter):
+            logger.warning("Rate limited by Telegram: %s", error)
+            return
+        if isinstance(error, (NetworkError, TimedOut)):
+            logger.warning("Network error: %s", error)
+            return
+        logger.error("Unhandled error: %s", error, exc_info=error)
 
     application.add_error_handler(error_handler)
 
-    # Signal handler for graceful shutdown
-    def signal_handler(sig, frame):
-        logger.info("Received shutdown signal, stopping...")
-        os._exit(0)
-
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
-
-    # Set up bot command menu
+    # Start the audio server; other start-up work runs in the background so
+    # polling starts right away. Application.initialize() has already called
+    # get_me, so the Telegram connection is warm; also connect to the saved
+    # Cast device so the first message doesn't pay for discovery and connect.
     async def post_init(app: Application) -> None:
-        await app.bot.set_my_commands(
-            [
-                BotCommand("start", "Welcome & help"),
-                BotCommand("setup", "Configure playback device"),
-                BotCommand("connect", "Wake up & connect to device"),
-                BotCommand("status", "Show current device"),
-                BotCommand("devices", "List available devices"),
-                BotCommand("help", "Show help message"),
-            ]
-        )
+        await audio_server.start()
+        run_in_background(sync_bot_commands(app.bot))
+        run_in_background(warm_up_cast_connection())
+        run_in_background(clean_audio_dir())
+
+    # Stop background tasks and release the audio server, Cast connection and
+    # discovery on shutdown
+    async def post_shutdown(app: Application) -> None:
+        for task in list(_background_tasks):
+            task.cancel()
+        await audio_server.stop()
+        cast_connection.disconnect()
+        cast_discovery.stop()
+        remove_leftover_audio()
+        CAST_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+        TTS_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+        DISCOVERY_EXECUTOR.shutdown(wait=False, cancel_futures=True)
 
     application.post_init = post_init
+    application.post_shutdown = post_shutdown
 
-    # Run bot with drop_pending_updates to avoid conflicts
-    logger.info("Starting Telegram Speaker Bot...")
-    application.run_polling(
-        allowed_updates=Update.ALL_TYPES,
-        drop_pending_updates=True,
-    )
+    # Discover Cast devices in the background from startup on, probing the
+    # configured device's last known address directly
+    device = config.selected_device
+    known_hosts = [device.address] if device and device.address else None
+    cast_discovery.start(known_hosts)
+
+    # Use uvloop when available for a faster event loop
+    if sys.platform != "win32":
+        try:
+            import uvloop
+
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        except ImportError:
+            logger.info("uvloop not installed, using default asyncio loop")
+
+    # Run bot with drop_pending_updates to avoid conflicts; SIGINT/SIGTERM
+    # stop receiving updates and shut the application down gracefully
+    run_options = {
+        "bootstrap_retries": -1,
+        "allowed_updates": ALLOWED_UPDATES,
+        "drop_pending_updates": True,
+        "stop_signals": STOP_SIGNALS,
+    }
+    if WEBHOOK_URL:
+        # Telegram pushes updates to us; requires a public HTTPS endpoint
+        logger.info("Starting Telegram Speaker Bot (webhook)...")
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=WEBHOOK_PORT,
+            url_path=token,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{token}",
+            secret_token=WEBHOOK_SECRET,
+            **run_options,
+        )
+    else:
+        logger.info("Starting Telegram Speaker Bot (polling)...")
+        application.run_polling(
+            poll_interval=0.0,
+            timeout=POLL_TIMEOUT,
+            **run_options,
+        )
 
 
 if __name__ == "__main__":
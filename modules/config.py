@@ -1,24 +1,51 @@
 """Configuration and constants."""
 
+import json
 import logging
+import os
 from pathlib import Path
 
-import yaml
-
 logger = logging.getLogger(__name__)
 
 # Paths
 SCRIPT_DIR = Path(__file__).parent.parent
-CONFIG_FILE = SCRIPT_DIR / "config.yml"
+CONFIG_FILE = SCRIPT_DIR / "config.json"
+LEGACY_CONFIG_FILE = SCRIPT_DIR / "config.yml"
 AUDIO_DIR = SCRIPT_DIR / "audio"
 AUDIO_DIR.mkdir(exist_ok=True)
 
-# Allowed user IDs
-ALLOWED_USERS = {1212454889}
+
+def parse_user_ids(raw: str) -> frozenset[int]:
+    """Parse comma-separated Telegram user IDs, ignoring empty items."""
+    try:
+        return frozenset(int(u) for u in raw.split(",") if u.strip())
+    except ValueError:
+        raise ValueError(
+            f"ALLOWED_USERS must be comma-separated Telegram user IDs, got {raw!r}"
+        ) from None
+
+
+# Allowed user IDs (comma-separated in the environment)
+ALLOWED_USERS = parse_user_ids(os.environ.get("ALLOWED_USERS", "1212454889"))
+
+# Concurrency limits
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "32"))
+MEDIA_CONCURRENCY = int(os.environ.get("MEDIA_CONCURRENCY", "4"))
+
+# Number of synthesized phrases kept in AUDIO_DIR for reuse
+TTS_CACHE_SIZE = int(os.environ.get("TTS_CACHE_SIZE", "50"))
+
+# Port for the audio file server Chromecast fetches from (0 picks a free port)
+AUDIO_PORT = int(os.environ.get("AUDIO_PORT", "0"))
+
+# Webhook mode (long polling is used when WEBHOOK_URL is not set)
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
 
 
 class Config:
-    """Application configuration loaded from config.yml."""
+    """Application configuration loaded from config.json."""
 
     def __init__(self):
         # Import here to avoid circular imports
@@ -26,17 +53,35 @@ class Config:
 
         self._device_class = Device
         self.selected_device: "Device | None" = None
+        self._saved_data: dict | None = None  # What the file currently holds
         self.load()
 
     def load(self):
         """Load configuration from file."""
         if CONFIG_FILE.exists():
-            with open(CONFIG_FILE) as f:
-                data = yaml.safe_load(f) or {}
-                if "selected_device" in data and data["selected_device"]:
-                    self.selected_device = self._device_class.from_dict(
-                        data["selected_device"]
-                    )
+            data = json.loads(CONFIG_FILE.read_text(encoding="utf-8")) or {}
+        elif LEGACY_CONFIG_FILE.exists():
+            data = self._migrate_legacy()
+        else:
+            return
+        self._saved_data = data
+        if "selected_device" in data and data["selected_device"]:
+            self.selected_device = self._device_class.from_dict(data["selected_device"])
+
+    def _migrate_legacy(self) -> dict:
+        """Convert the old config.yml to config.json, returning its data."""
+        import yaml  # Only needed once, for the migration
+
+        # Prefer the libyaml-backed loader when PyYAML was built with it
+        loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+        with open(LEGACY_CONFIG_FILE, encoding="utf-8") as f:
+            data = yaml.load(f, Loader=loader) or {}
+        CONFIG_FILE.write_text(
+            json.dumps(data, indent=2, ensure_ascii=False), encoding="utf-8"
+        )
+        LEGACY_CONFIG_FILE.unlink()
+        logger.info("Migrated %s to %s", LEGACY_CONFIG_FILE.name, CONFIG_FILE.name)
+        return data
 
     def save(self):
         """Save configuration to file."""
@@ -45,8 +90,12 @@ class Config:
             if self.selected_device
             else None
         }
-        with open(CONFIG_FILE, "w") as f:
-            yaml.dump(data, f, default_flow_style=False)
+        if data == self._saved_data:
+            return  # Nothing changed, skip the write
+        CONFIG_FILE.write_text(
+            json.dumps(data, indent=2, ensure_ascii=False), encoding="utf-8"
+        )
+        self._saved_data = data
 
 
 # Global config instance
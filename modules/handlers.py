@@ -2,112 +2,103 @@
 
 import asyncio
 import logging
-import subprocess
-import tempfile
+import uuid
 from pathlib import Path
 
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram import (
+    Audio,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    Update,
+    Voice,
+)
 from telegram.ext import ContextTypes
 
-from .config import ALLOWED_USERS, config
+from .config import ALLOWED_USERS, AUDIO_DIR, MEDIA_CONCURRENCY, config
 from .models import DeviceType
-from .services import cast_connection, play_audio, speak_text_macos
-from .tts import expand_variables, text_to_mp3
+from .services import (
+    DISCOVERY_EXECUTOR,
+    TTS_EXECUTOR,
+    cast_connection,
+    connect_cast,
+    play_audio,
+    play_mp3_bytes_on_googlecast,
+    speak_text_macos,
+)
+from .tts import (
+    TTS_VOICE,
+    bytes_to_mp3,
+    cached_text_to_mp3,
+    expand_variables,
+    text_to_mp3_bytes,
+)
 from .utils import discover_all_devices
 
 logger = logging.getLogger(__name__)
 
+# Bound concurrent media jobs (download + convert + play) to cap memory use
+media_semaphore = asyncio.Semaphore(MEDIA_CONCURRENCY)
+
+
+def new_audio_path(suffix: str) -> Path:
+    """Get a unique path in AUDIO_DIR, where the audio server can serve it."""
+    return AUDIO_DIR / f"{uuid.uuid4().hex}{suffix}"
+
+
+# Fixed replies, built once at import
+WELCOME_TEXT = (
+    "Welcome to Telegram Speaker Bot!\n\n"
+    "Send me a voice message or text and I'll play it on your device.\n\n"
+    "Commands:\n"
+    "/setup - Configure playback device\n"
+    "/connect - Wake up and connect to device\n"
+    "/status - Show current device\n"
+    "/devices - List available devices\n"
+    "/help - Show this help message"
+)
+
+NO_DEVICE_TEXT = "No device configured. Use /setup to select a playback device."
+
 
 def is_authorized(update: Update) -> bool:
     """Check if user is authorized."""
-    user_id = update.effective_user.id if update.effective_user else None
-    if user_id not in ALLOWED_USERS:
-        logger.warning(f"Unauthorized access attempt from user {user_id}")
-        return False
-    return True
-
-
-class ProgressAnimation:
-    """Text-based progress animation for Telegram messages."""
-
-    FRAMES = [
-        "[ o ] Processing",
-        "[ o ] Processing",
-        "[ o ] Processing",
-        "[ o ] Processing",
-    ]
-
-    PLAY_FRAMES = [
-        "> Playing  ░░░░░░░░░░",
-        "> Playing  ▓░░░░░░░░░",
-        "> Playing  ▓▓░░░░░░░░",
-        "> Playing  ▓▓▓░░░░░░░",
-        "> Playing  ▓▓▓▓░░░░░░",
-        "> Playing  ▓▓▓▓▓░░░░░",
-        "> Playing  ▓▓▓▓▓▓░░░░",
-        "> Playing  ▓▓▓▓▓▓▓░░░",
-        "> Playing  ▓▓▓▓▓▓▓▓░░",
-        "> Playing  ▓▓▓▓▓▓▓▓▓░",
-        "> Playing  ▓▓▓▓▓▓▓▓▓▓",
-    ]
+    user = update.effective_user
+    user_id = user.id if user else None
+    if user_id in ALLOWED_USERS:
+        return True
+    logger.warning("Unauthorized access attempt from user %s", user_id)
+    return False
+
+
+class ProgressStatus:
+    """Progress status for Telegram messages, edited once per stage."""
+
+    PLAY_TEXT = "> Playing..."
 
     def __init__(self, message, device_name: str):
         self.message = message
         self.device_name = device_name
-        self.running = False
-        self.task = None
-
-    async def start(self, phase: str = "process"):
-        """Start the animation."""
-        self.running = True
-        self.task = asyncio.create_task(self._animate(phase))
-
-    async def stop(self):
-        """Stop the animation."""
-        self.running = False
-        if self.task:
-            self.task.cancel()
-            try:
-                await self.task
-            except asyncio.CancelledError:
-                pass
+        self.last_text: str | None = message.text
+
+    async def _show(self, status: str):
+        """Edit the message to show a stage, skipping unchanged text."""
+        text = f"{status}\n\n{self.device_name}"
+        if text == self.last_text:
+            return  # Telegram rejects edits that change nothing
+        try:
+            await self.message.edit_text(text)
+            self.last_text = text
+        except Exception:
+            pass  # Ignore edit errors
 
     async def switch_to_playing(self):
-        """Switch to playing animation."""
-        await self.stop()
-        self.running = True
-        self.task = asyncio.create_task(self._animate("play"))
-
-    async def _animate(self, phase: str):
-        """Run animation loop."""
-        frames = self.PLAY_FRAMES if phase == "play" else self.FRAMES
-        idx = 0
-        while self.running:
-            frame = frames[idx % len(frames)]
-            text = f"{frame}\n\n{self.device_name}"
-            try:
-                await self.message.edit_text(text)
-            except Exception:
-                pass  # Ignore edit errors
-            idx += 1
-            await asyncio.sleep(0.5 if phase == "play" else 0.3)
+        """Show the playing stage."""
+        await self._show(self.PLAY_TEXT)
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle /start command."""
-    if not is_authorized(update):
-        return
-    welcome_text = (
-        "Welcome to Telegram Speaker Bot!\n\n"
-        "Send me a voice message or text and I'll play it on your device.\n\n"
-        "Commands:\n"
-        "/setup - Configure playback device\n"
-        "/connect - Wake up and connect to device\n"
-        "/status - Show current device\n"
-        "/devices - List available devices\n"
-        "/help - Show this help message"
-    )
-    await update.message.reply_text(welcome_text)
+    await update.message.reply_text(WELCOME_TEXT)
 
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -117,14 +108,10 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle /status command - show current device."""
-    if not is_authorized(update):
-        return
     if config.selected_device:
         device = config.selected_device
         status_text = (
-            f"Current device:\n"
-            f"  Name: {device.name}\n"
-            f"  Type: {device.device_type.value}\n"
+            f"Current device:\n  Name: {device.name}\n  Type: {device.device_type}\n"
         )
         if device.address:
             status_text += f"  Address: {device.address}\n"
@@ -136,8 +123,6 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 async def connect(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle /connect command - wake up and connect to device."""
-    if not is_authorized(update):
-        return
     if not config.selected_device:
         await update.message.reply_text("No device configured. Use /setup first.")
         return
@@ -159,8 +144,7 @@ async def connect(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         f"[ o ] Connecting to {device.name}...\n\nThis may wake up the device."
     )
 
-    loop = asyncio.get_event_loop()
-    success = await loop.run_in_executor(None, cast_connection.connect, device)
+    success = await connect_cast(device)
 
     if success:
         await status_msg.edit_text(
@@ -176,12 +160,12 @@ async def connect(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 async def devices(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle /devices command - list available devices."""
-    if not is_authorized(update):
-        return
     await update.message.reply_text("Scanning for devices...")
 
-    loop = asyncio.get_event_loop()
-    found_devices = await loop.run_in_executor(None, discover_all_devices, 5)
+    loop = asyncio.get_running_loop()
+    found_devices = await loop.run_in_executor(
+        DISCOVERY_EXECUTOR, discover_all_devices, 5
+    )
 
     if not found_devices:
         await update.message.reply_text("No devices found.")
@@ -189,23 +173,23 @@ async def devices(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     text = "Available devices:\n\n"
     for i, device in enumerate(found_devices, 1):
-        text += f"{i}. {device.name} ({device.device_type.value})\n"
+        text += f"{i}. {device.name} ({device.device_type})\n"
 
     await update.message.reply_text(text)
 
 
 async def setup(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle /setup command - start device selection flow."""
-    if not is_authorized(update):
-        return
     await update.message.reply_text(
         "Starting device setup...\n\n"
         "Step 1/3: Scanning for available devices...\n"
-        "Please wait (~15 seconds) while I discover devices on your network."
+        "This takes up to ~15 seconds if no devices have been found yet."
     )
 
-    loop = asyncio.get_event_loop()
-    found_devices = await loop.run_in_executor(None, discover_all_devices, 15)
+    loop = asyncio.get_running_loop()
+    found_devices = await loop.run_in_executor(
+        DISCOVERY_EXECUTOR, discover_all_devices, 15
+    )
 
     if not found_devices:
         await update.message.reply_text(
@@ -217,8 +201,8 @@ async def setup(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         )
         return
 
-    # Store devices in context for callback
-    context.user_data["setup_devices"] = found_devices
+    # Store devices in context for callback (replaces any earlier /setup)
+    context.user_data["setup_devices"] = {d.id: d for d in found_devices}
 
     # Create keyboard with device options
     keyboard = []
@@ -247,24 +231,20 @@ async def setup(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle button callbacks from inline keyboards."""
+    # Callback queries can't be filtered by user in main, so check here
     if not is_authorized(update):
         return
     query = update.callback_query
     await query.answer()
 
     if query.data == "cancel_setup":
+        context.user_data.pop("setup_devices", None)
         await query.edit_message_text("Setup cancelled.")
         return
 
     if query.data.startswith("select_"):
-        device_id = query.data[7:]  # Remove "select_" prefix
-
-        devices_list = context.user_data.get("setup_devices", [])
-        selected = None
-        for device in devices_list:
-            if device.id == device_id:
-                selected = device
-                break
+        device_id = query.data.removeprefix("select_")
+        selected = context.user_data.get("setup_devices", {}).get(device_id)
 
         if not selected:
             await query.edit_message_text("Device not found. Please run /setup again.")
@@ -273,26 +253,24 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         # Save selection
         config.selected_device = selected
         config.save()
+        context.user_data.pop("setup_devices", None)
 
         await query.edit_message_text(
             f"Step 3/3: Setup complete!\n\n"
             f"Selected device: {selected.name}\n"
-            f"Type: {selected.device_type.value}\n\n"
+            f"Type: {selected.device_type}\n\n"
             f"You can now send voice messages and they will play on this device.\n\n"
             f"Use /status to check current device\n"
             f"Use /setup to change device"
         )
 
-    if query.data == "confirm_test":
+    elif query.data == "confirm_test":
         if (
             config.selected_device
             and config.selected_device.device_type == DeviceType.MACOS_SAY
         ):
             await query.edit_message_text("Playing test message...")
-            loop = asyncio.get_event_loop()
-            success = await loop.run_in_executor(
-                None, speak_text_macos, "Telegram Speaker Bot is ready!"
-            )
+            success = await speak_text_macos("Telegram Speaker Bot is ready!")
             if success:
                 await query.edit_message_text("Test complete! Setup finished.")
             else:
@@ -303,175 +281,172 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle incoming voice messages."""
-    if not is_authorized(update):
-        return
     if not config.selected_device:
-        await update.message.reply_text(
-            "No device configured. Use /setup to select a playback device."
-        )
+        await update.message.reply_text(NO_DEVICE_TEXT)
         return
 
-    # Send initial message and start animation
-    status_msg = await update.message.reply_text(
-        f"[ o ] Processing\n\n{config.selected_device.name}"
-    )
-    anim = ProgressAnimation(status_msg, config.selected_device.name)
-    await anim.start("process")
-
-    # Download voice message
-    voice = update.message.voice
-    file = await context.bot.get_file(voice.file_id)
-
-    # Save to temp file
-    with tempfile.NamedTemporaryFile(suffix=".ogg", delete=False) as tmp:
-        tmp_path = Path(tmp.name)
-
-    await file.download_to_drive(tmp_path)
-
-    # Convert OGG to MP3 for better compatibility
-    mp3_path = tmp_path.with_suffix(".mp3")
-    try:
-        subprocess.run(
-            [
-                "ffmpeg",
-                "-y",
-                "-i",
-                str(tmp_path),
-                "-acodec",
-                "libmp3lame",
-                str(mp3_path),
-            ],
-            check=True,
-            capture_output=True,
+    async with media_semaphore:
+        # Send initial message; it shows the processing stage
+        status_msg = await update.message.reply_text(
+            f"[ o ] Processing\n\n{config.selected_device.name}"
         )
-    except subprocess.CalledProcessError as e:
-        logger.error(f"FFmpeg conversion failed: {e}")
-        mp3_path = tmp_path
-    except FileNotFoundError:
-        logger.warning("FFmpeg not found, trying to play OGG directly")
-        mp3_path = tmp_path
-
-    # Switch to playing animation
-    await anim.switch_to_playing()
-
-    # Play audio
-    success = await play_audio(config.selected_device, mp3_path)
-
-    # Stop animation
-    await anim.stop()
-
-    # Cleanup
-    tmp_path.unlink(missing_ok=True)
-    if mp3_path != tmp_path:
-        mp3_path.unlink(missing_ok=True)
+        progress = ProgressStatus(status_msg, config.selected_device.name)
+
+        # Download voice message
+        voice = update.message.voice
+        file = await context.bot.get_file(voice.file_id)
+
+        # Google Cast plays OGG/Opus directly, so save it into the served audio
+        # directory as is; afplay can't, so pipe the download through ffmpeg
+        # and write only the MP3
+        local = config.selected_device.device_type == DeviceType.MACOS_SAY
+        audio_path = new_audio_path(".mp3" if local else ".ogg")
+        try:
+            if local:
+                ogg_data = await file.download_as_bytearray()
+                success = await bytes_to_mp3(bytes(ogg_data), audio_path)
+            else:
+                await file.download_to_drive(audio_path)
+                success = True
 
-    if success:
-        await status_msg.edit_text(
-            f"Playback complete\n\n{config.selected_device.name}"
-        )
-    else:
-        await update.message.reply_text(
-            "Playback failed. Check the device connection and try again."
-        )
+            if success:
+                # Show the playing stage
+                await progress.switch_to_playing()
+
+                # Play audio
+                success = await play_audio(config.selected_device, audio_path)
+        finally:
+            # Clean up, even if anything failed
+            audio_path.unlink(missing_ok=True)
+
+        if success:
+            await status_msg.edit_text(
+                f"Playback complete\n\n{config.selected_device.name}"
+            )
+        else:
+            await update.message.reply_text(
+                "Playback failed. Check the device connection and try again."
+            )
 
 
 async def handle_audio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle incoming audio files."""
-    if not is_authorized(update):
-        return
     if not config.selected_device:
-        await update.message.reply_text(
-            "No device configured. Use /setup to select a playback device."
-        )
+        await update.message.reply_text(NO_DEVICE_TEXT)
         return
 
-    # Send initial message and start animation
-    status_msg = await update.message.reply_text(
-        f"[ o ] Processing\n\n{config.selected_device.name}"
-    )
-    anim = ProgressAnimation(status_msg, config.selected_device.name)
-    await anim.start("process")
-
-    # Download audio file
-    audio = update.message.audio
-    file = await context.bot.get_file(audio.file_id)
-
-    with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as tmp:
-        tmp_path = Path(tmp.name)
-
-    await file.download_to_drive(tmp_path)
+    async with media_semaphore:
+        # Send initial message; it shows the processing stage
+        status_msg = await update.message.reply_text(
+            f"[ o ] Processing\n\n{config.selected_device.name}"
+        )
+        progress = ProgressStatus(status_msg, config.selected_device.name)
 
-    # Switch to playing animation
-    await anim.switch_to_playing()
+        # Download audio file
+        audio = update.message.audio
+        file = await context.bot.get_file(audio.file_id)
 
-    # Play audio
-    success = await play_audio(config.selected_device, tmp_path)
+        # Keep Telegram's extension so the file is served with the right type
+        audio_path = new_audio_path(Path(file.file_path or "").suffix or ".mp3")
+        try:
+            await file.download_to_drive(audio_path)
 
-    # Stop animation
-    await anim.stop()
+            # Show the playing stage
+            await progress.switch_to_playing()
 
-    # Cleanup
-    tmp_path.unlink(missing_ok=True)
+            # Play audio
+            success = await play_audio(config.selected_device, audio_path)
+        finally:
+            # Clean up, even if anything failed
+            audio_path.unlink(missing_ok=True)
 
-    if success:
-        await status_msg.edit_text(
-            f"Playback complete\n\n{config.selected_device.name}"
-        )
-    else:
-        await status_msg.edit_text(f"Playback failed\n\n{config.selected_device.name}")
+        if success:
+            await status_msg.edit_text(
+                f"Playback complete\n\n{config.selected_device.name}"
+            )
+        else:
+            await status_msg.edit_text(
+                f"Playback failed\n\n{config.selected_device.name}"
+            )
 
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle text messages - convert to speech and play."""
-    if not is_authorized(update):
-        return
     if not config.selected_device:
-        await update.message.reply_text(
-            "No device configured. Use /setup to select a playback device."
-        )
+        await update.message.reply_text(NO_DEVICE_TEXT)
         return
 
     text = update.message.text
     if not text or text.startswith("/"):
         return  # Ignore commands
 
-    # Expand variables like $TIME
+    # Expand variables like $TIME; phrases without them can be cached
+    raw_text = text
     text = expand_variables(text)
+    cacheable = text == raw_text
 
-    # Send initial message and start animation
+    # say speaks on the Mac's own speakers, so no MP3 is needed there
+    speak_locally = config.selected_device.device_type == DeviceType.MACOS_SAY
+
+    # Send initial message with the first stage
+    first_stage = (
+        ProgressStatus.PLAY_TEXT if speak_locally else "[ o ] Converting to speech"
+    )
     status_msg = await update.message.reply_text(
-        f"[ o ] Converting to speech\n\n{config.selected_device.name}"
+        f"{first_stage}\n\n{config.selected_device.name}"
     )
-    anim = ProgressAnimation(status_msg, config.selected_device.name)
-    await anim.start("process")
-
-    # Convert text to MP3
-    with tempfile.NamedTemporaryFile(suffix=".mp3", delete=False) as tmp:
-        mp3_path = Path(tmp.name)
-
-    loop = asyncio.get_event_loop()
-    tts_success = await loop.run_in_executor(None, text_to_mp3, text, mp3_path)
-
-    if not tts_success:
-        await anim.stop()
-        await status_msg.edit_text("TTS conversion failed")
-        return
-
-    # Switch to playing animation
-    await anim.switch_to_playing()
+    progress = ProgressStatus(status_msg, config.selected_device.name)
 
-    # Play audio
-    success = await play_audio(config.selected_device, mp3_path)
+    if speak_locally:
+        success = await speak_text_macos(text, TTS_VOICE)
+    else:
+        # Convert text to MP3
+        loop = asyncio.get_running_loop()
+        if cacheable:
+            mp3_path = await loop.run_in_executor(
+                TTS_EXECUTOR, cached_text_to_mp3, text
+            )
+            tts_success = mp3_path is not None
+        else:
+            # One-off phrases stay in memory and are never written to AUDIO_DIR
+            mp3_data = await loop.run_in_executor(TTS_EXECUTOR, text_to_mp3_bytes, text)
+            tts_success = mp3_data is not None
+
+        if not tts_success:
+            await status_msg.edit_text("TTS conversion failed")
+            return
 
-    # Stop animation
-    await anim.stop()
+        # Show the playing stage
+        await progress.switch_to_playing()
 
-    # Cleanup
-    mp3_path.unlink(missing_ok=True)
+        # Play audio
+        if cacheable:
+            success = await play_audio(config.selected_device, mp3_path)
+        else:
+            success = await play_mp3_bytes_on_googlecast(
+                config.selected_device, mp3_data
+            )
 
     if success:
+        preview = text if len(text) <= 50 else f"{text[:50]}..."
         await status_msg.edit_text(
-            f"Playback complete\n\n{config.selected_device.name}\n{text[:50]}{'...' if len(text) > 50 else ''}"
+            f"Playback complete\n\n{config.selected_device.name}\n{preview}"
         )
     else:
         await status_msg.edit_text(f"Playback failed\n\n{config.selected_device.name}")
+
+
+# Message handlers keyed by the type of the message's attachment (text has none)
+MESSAGE_HANDLERS = {
+    Voice: handle_voice,
+    Audio: handle_audio,
+    type(None): handle_text,
+}
+
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Dispatch voice, audio and text messages to their handlers."""
+    attachment = update.message.effective_attachment
+    handler = MESSAGE_HANDLERS.get(type(attachment))
+    if handler:
+        await handler(update, context)
@@ -0,0 +1,55 @@
+"""Logging configuration."""
+
+import logging
+import logging.handlers
+import os
+
+from .config import SCRIPT_DIR
+
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+LOG_FILE = SCRIPT_DIR / "logs" / "bot.log"
+DEFAULT_LOG_LEVEL = "WARNING"
+LOG_LEVEL = os.environ.get("LOG_LEVEL", DEFAULT_LOG_LEVEL).upper()
+
+# Libraries that log too much at INFO level
+NOISY_LOGGERS = ("httpx", "httpcore", "pychromecast", "zeroconf", "telegram")
+
+
+def setup_logging() -> None:
+    """Configure console and rotating file logging on the root logger."""
+    # Ensure log directory exists
+    LOG_FILE.parent.mkdir(exist_ok=True)
+
+    # Fall back to the default rather than fail on a mistyped LOG_LEVEL
+    valid_level = LOG_LEVEL in logging.getLevelNamesMapping()
+    level = LOG_LEVEL if valid_level else DEFAULT_LOG_LEVEL
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(level)
+    formatter = logging.Formatter(LOG_FORMAT)
+
+    # Console handler
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(level)
+    console_handler.setFormatter(formatter)
+    root_logger.addHandler(console_handler)
+
+    # File handler with rotation (5MB per file, keep 5 backups)
+    file_handler = logging.handlers.RotatingFileHandler(
+        LOG_FILE,
+        maxBytes=5 * 1024 * 1024,  # 5MB
+        backupCount=5,
+        encoding="utf-8",
+    )
+    file_handler.setLevel(level)
+    file_handler.setFormatter(formatter)
+    root_logger.addHandler(file_handler)
+
+    # Silence noisy library logs
+    for name in NOISY_LOGGERS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    if not valid_level:
+        logging.getLogger(__name__).warning(
+            "Unknown LOG_LEVEL %r, using %s", LOG_LEVEL, DEFAULT_LOG_LEVEL
+        )
@@ -1,17 +1,17 @@
 """Data models and types."""
 
 from dataclasses import dataclass
-from enum import Enum
+from enum import StrEnum
 
 
-class DeviceType(Enum):
+class DeviceType(StrEnum):
     """Type of playback device."""
 
     GOOGLE_CAST = "googlecast"
     MACOS_SAY = "macos_say"
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Device:
     """Represents a playback device."""
 
@@ -19,6 +19,7 @@ class Device:
     name: str
     address: str | None
     device_type: DeviceType
+    port: int = 8009  # Cast port; speaker groups use their own
 
     def to_dict(self) -> dict:
         """Convert to dictionary for serialization."""
@@ -26,7 +27,8 @@ class Device:
             "id": self.id,
             "name": self.name,
             "address": self.address,
-            "device_type": self.device_type.value,
+            "device_type": self.device_type,
+            "port": self.port,
         }
 
     @classmethod
@@ -37,4 +39,5 @@ class Device:
             name=data["name"],
             address=data.get("address"),
             device_type=DeviceType(data["device_type"]),
+            port=data.get("port", 8009),
         )
@@ -1,28 +1,119 @@
 """Core services: Cast connection, audio server, playback."""
 
 import asyncio
+import dataclasses
 import logging
-import os
-import subprocess
+import mimetypes
+import socket
 import threading
 import time
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from uuid import UUID
 
 import pychromecast
-
+from aiohttp import web
+from pychromecast.controllers.media import MediaStatus, MediaStatusListener
+from pychromecast.socket_client import (
+    CONNECTION_STATUS_CONNECTED,
+    ConnectionStatus,
+    ConnectionStatusListener,
+    SocketClient,
+)
+
+from .config import AUDIO_DIR, AUDIO_PORT, config
 from .models import Device, DeviceType
-from .utils import get_local_ip
+from .tts import TTS_CACHE_PREFIX, convert_to_mp3, say_voice_args
+from .utils import cast_discovery, get_local_ip
 
 logger = logging.getLogger(__name__)
 
+# MIME types for audio files handed to Google Cast; other extensions are
+# looked up with mimetypes, which names WAV audio/x-wav
+AUDIO_MIME_TYPES = {
+    ".mp3": "audio/mpeg",
+    ".ogg": "audio/ogg",
+    ".m4a": "audio/mp4",
+    ".wav": "audio/wav",
+}
+
+
+def audio_mime_type(name: str) -> str:
+    """Get the MIME type to announce to a Cast device for an audio file."""
+    suffix = Path(name).suffix.lower()
+    if suffix in AUDIO_MIME_TYPES:
+        return AUDIO_MIME_TYPES[suffix]
+    mime_type = mimetypes.guess_type(name)[0]
+    if mime_type and mime_type.startswith("audio/"):
+        return mime_type
+    return "audio/mpeg"
+
+
+# Cast I/O shares one connection, so run it on a single long-lived worker that
+# owns it (the executor's work queue serializes play commands); pychromecast's
+# socket thread handles heartbeats and reconnects out of band. TTS and
+# discovery get their own workers so they aren't stuck behind a long playback
+CAST_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cast")
+TTS_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="tts")
+DISCOVERY_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="discovery")
 
-class SilentHTTPHandler(SimpleHTTPRequestHandler):
-    """HTTP handler that suppresses access logs."""
+# How long to try a device's saved address before falling back to discovery
+DIRECT_CONNECT_TIMEOUT = 3
 
-    def log_message(self, format, *args):
-        """Suppress all HTTP access logs."""
-        pass
+# How long to wait for a Google Cast device to start and finish playback
+PLAYBACK_START_TIMEOUT = 5
+PLAYBACK_TIMEOUT = 120
+
+
+class PlaybackListener(MediaStatusListener):
+    """Turn media status pushes from a Cast device into events."""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.finished = threading.Event()
+        self.idle_reason: str | None = None
+
+    def reset(self):
+        """Prepare for a new play_media call."""
+        self.started.clear()
+        self.finished.clear()
+        self.idle_reason = None
+
+    def new_media_status(self, status: MediaStatus):
+        """Called from the socket thread whenever the media status changes."""
+        if status.player_state == "PLAYING":
+            self.started.set()
+        elif status.player_state == "IDLE" and (
+            self.started.is_set() or status.idle_reason
+        ):
+            self.idle_reason = status.idle_reason
+            self.finished.set()
+
+    def load_media_failed(self, queue_item_id: int, error_code: int):
+        """Called when the device refuses to load the media."""
+        self.idle_reason = f"LOAD_FAILED ({error_code})"
+        self.finished.set()
+
+
+class NoDelayListener(ConnectionStatusListener):
+    """Disable Nagle on the Cast control socket after every (re)connect.
+
+    Control messages are small and answered one at a time, so batching
+    them only adds delay.
+    """
+
+    def __init__(self, socket_client: SocketClient):
+        self.socket_client = socket_client
+
+    def new_connection_status(self, status: ConnectionStatus):
+        """Called from the socket thread when the connection state changes."""
+        sock = self.socket_client.socket
+        if status.status == CONNECTION_STATUS_CONNECTED and sock:
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except OSError as e:
+                logger.debug("Could not set TCP_NODELAY: %s", e)
 
 
 class CastConnection:
@@ -30,63 +121,109 @@ class CastConnection:
 
     def __init__(self):
         self.cast = None
-        self.browser = None
         self.connected = False
         self.device_id: str | None = None
+        # Where the connected device was found: (host, port)
+        self.location: tuple[str, int] | None = None
+        self.listener = PlaybackListener()
 
     def connect(self, device: Device, timeout: int = 15) -> bool:
-        """Connect to a Google Cast device."""
+        """Connect to a Google Cast device, reusing a live connection to it.
+
+        Only called on CAST_EXECUTOR, whose single worker serializes connects.
+        """
         if device.device_type != DeviceType.GOOGLE_CAST:
             return False
+        if self.device_id == device.id and self.is_connected():
+            return True
 
-        # Disconnect existing connection if different device
-        if self.device_id and self.device_id != device.id:
+        # Drop any existing or stale connection first
+        if self.cast:
             self.disconnect()
 
         try:
-            logger.info(f"Connecting to {device.name}...")
-            chromecasts, self.browser = pychromecast.get_chromecasts(timeout=timeout)
-
-            self.cast = None
-            for cc in chromecasts:
-                if str(cc.uuid) == device.id:
-                    self.cast = cc
-                    break
-
+            logger.info("Connecting to %s...", device.name)
+            self.cast = self._connect_direct(device) or self._connect_discovered(
+                device, timeout
+            )
             if not self.cast:
-                logger.error(f"Device not found: {device.name}")
-                self.disconnect()
+                logger.error("Device not found: %s", device.name)
                 return False
 
-            self.cast.wait(timeout=10)
-            time.sleep(1)  # Stabilize connection
-
             self.device_id = device.id
+            self.location = (self.cast.cast_info.host, self.cast.cast_info.port)
             self.connected = True
-            logger.info(f"Connected to {self.cast.cast_info.friendly_name}")
-
-            # Stop discovery but keep connection
-            if self.browser:
-                self.browser.stop_discovery()
-                self.browser = None
-
+            logger.info("Connected to %s", self.cast.cast_info.friendly_name)
             return True
 
         except Exception as e:
-            logger.error(f"Connection failed: {e}")
+            logger.error("Connection failed: %s", e)
             self.disconnect()
+            # The network may have changed; look up the local IP again
+            get_local_ip.cache_clear()
             return False
 
+    def _open(
+        self, cast: pychromecast.Chromecast, timeout: float = 10
+    ) -> pychromecast.Chromecast:
+        """Attach the playback listener and wait until the device is ready."""
+        cast.media_controller.register_status_listener(self.listener)
+        cast.socket_client.register_connection_listener(
+            NoDelayListener(cast.socket_client)
+        )
+        # wait() returns once the socket is connected and status received
+        cast.wait(timeout=timeout)
+        return cast
+
+    def _connect_direct(self, device: Device) -> "pychromecast.Chromecast | None":
+        """Connect straight to the saved address, skipping mDNS discovery."""
+        if not device.address or cast_discovery.get_cast_info(device.id, 0):
+            return None  # Nothing saved, or discovery already has fresh info
+        cast = None
+        try:
+            cast = pychromecast.get_chromecast_from_host(
+                (device.address, device.port, UUID(device.id), None, device.name),
+                tries=1,
+                timeout=DIRECT_CONNECT_TIMEOUT,
+            )
+            cast = self._open(cast, DIRECT_CONNECT_TIMEOUT)
+            # Once connected, let the socket thread reconnect on its own
+            cast.socket_client.tries = None
+            return cast
+        except Exception as e:
+            logger.info("Direct connect to %s failed (%s), discovering", device.name, e)
+            if cast:
+                cast.disconnect()
+            return None
+
+    def _connect_discovered(
+        self, device: Device, timeout: int
+    ) -> "pychromecast.Chromecast | None":
+        """Connect using the device's current mDNS or host-probe info."""
+        if device.address:
+            cast_discovery.add_known_host(device.address)
+        cast_info = cast_discovery.get_cast_info(device.id, timeout)
+        if not cast_info:
+            return None
+
+        cast = pychromecast.get_chromecast_from_cast_info(
+            cast_info, cast_discovery.zconf
+        )
+        try:
+            return self._open(cast)
+        except Exception:
+            # Not yet self.cast, so connect's cleanup can't reach it
+            cast.disconnect()
+            raise
+
     def disconnect(self):
         """Disconnect from the device."""
-        if self.browser:
-            self.browser.stop_discovery()
-            self.browser = None
         if self.cast:
             self.cast.disconnect()
         self.cast = None
         self.connected = False
         self.device_id = None
+        self.location = None
         logger.info("Disconnected")
 
     def is_connected(self) -> bool:
@@ -109,58 +246,162 @@ class CastConnection:
 cast_connection = CastConnection()
 
 
+def remember_cast_location(device: Device):
+    """Save where the connected device was found, so the next connect can go
+    direct.
+
+    Config is only written from the event loop, so callers run this after
+    awaiting Cast work on CAST_EXECUTOR rather than from the worker itself.
+    """
+    location = cast_connection.location
+    selected = config.selected_device
+    if (
+        not location
+        or cast_connection.device_id != device.id
+        or not selected
+        or selected.id != device.id
+        or location == (selected.address, selected.port)
+    ):
+        return
+    logger.info("%s moved to %s", device.name, location[0])
+    config.selected_device = dataclasses.replace(
+        selected, address=location[0], port=location[1]
+    )
+    config.save()
+
+
+async def connect_cast(device: Device) -> bool:
+    """Connect to a Google Cast device on CAST_EXECUTOR."""
+    loop = asyncio.get_running_loop()
+    success = await loop.run_in_executor(CAST_EXECUTOR, cast_connection.connect, device)
+    remember_cast_location(device)
+    return success
+
+
 class AudioServer:
-    """Simple HTTP server to serve audio files to Chromecast."""
+    """Long-lived aiohttp server that serves audio files to Chromecast."""
 
     def __init__(self, directory: Path, port: int = 0):
         self.directory = directory
         self.port = port
-        self.server: HTTPServer | None = None
-        self.thread: threading.Thread | None = None
-        self._original_dir: str | None = None
-
-    def start(self) -> int:
-        """Start the HTTP server."""
-        self._original_dir = os.getcwd()
-        os.chdir(self.directory)
-
-        self.server = HTTPServer(("", self.port), SilentHTTPHandler)
-        self.port = self.server.server_address[1]
-
-        self.thread = threading.Thread(target=self.server.serve_forever)
-        self.thread.daemon = True
-        self.thread.start()
-
+        self.runner: web.AppRunner | None = None
+        # One-off audio served from memory under /mem/<name>
+        self.buffers: dict[str, bytes] = {}
+
+    async def start(self) -> int:
+        """Start serving the audio directory in the running event loop."""
+        app = web.Application()
+        app.router.add_get("/mem/{name}", self._serve_buffer)
+        # Static routes answer with FileResponse: Range requests are honoured
+        # (Cast devices probe with one) and the body is sent with sendfile()
+        app.router.add_static("/", self.directory)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        # IPv4 only (Cast devices fetch over the LAN IPv4 address); reuse the
+        # address so a quick restart on a fixed AUDIO_PORT doesn't fail to bind
+        site = web.TCPSite(
+            self.runner, host="0.0.0.0", port=self.port, reuse_address=True
+        )
+        await site.start()
+        self.port = self.runner.addresses[0][1]
+        logger.info("Audio server listening on port %s", self.port)
         return self.port
 
-    def stop(self):
+    async def stop(self):
         """Stop the HTTP server."""
-        if self.server:
-            self.server.shutdown()
-        if self._original_dir:
-            os.chdir(self._original_dir)
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+    def url_for(self, audio_path: Path) -> str:
+        """Get the URL a Chromecast can fetch the audio file from."""
+        return f"http://{get_local_ip()}:{self.port}/{audio_path.name}"
+
+    def hold(self, name: str, data: bytes) -> str:
+        """Serve data from memory until released; returns its URL."""
+        self.buffers[name] = data
+        return f"http://{get_local_ip()}:{self.port}/mem/{name}"
+
+    def release(self, name: str):
+        """Stop serving an in-memory file."""
+        self.buffers.pop(name, None)
+
+    async def _serve_buffer(self, request: web.Request) -> web.Response:
+        """Serve an in-memory file, honouring Range like FileResponse does."""
+        name = request.match_info["name"]
+        data = self.buffers.get(name)
+        if data is None:
+            raise web.HTTPNotFound()
+        headers = {"Accept-Ranges": "bytes"}
+        content_type = audio_mime_type(name)
+        if "Range" not in request.headers:
+            return web.Response(body=data, headers=headers, content_type=content_type)
+
+        try:
+            start, stop, _ = request.http_range.indices(len(data))
+        except ValueError:
+            start, stop = 0, 0
+        if start >= stop:
+            raise web.HTTPRequestRangeNotSatisfiable(
+                headers={"Content-Range": f"bytes */{len(data)}"}
+            )
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{len(data)}"
+        return web.Response(
+            status=206,
+            body=data[start:stop],
+            headers=headers,
+            content_type=content_type,
+        )
+
+
+# Global audio server instance, started with the bot
+audio_server = AudioServer(AUDIO_DIR, AUDIO_PORT)
+
+
+def remove_leftover_audio(max_age: float = 0):
+    """Delete media left in AUDIO_DIR by interrupted jobs, keeping the TTS cache.
+
+    Only files older than max_age seconds are removed.
+    """
+    cutoff = time.time() - max_age
+    for path in AUDIO_DIR.iterdir():
+        if path.name.startswith(TTS_CACHE_PREFIX):
+            continue
+        try:
+            if path.is_file() and path.stat().st_mtime <= cutoff:
+                path.unlink()
+        except FileNotFoundError:
+            pass  # Removed by its job in the meantime
 
 
 def play_on_googlecast(device: Device, audio_path: Path) -> bool:
-    """Play audio file on Google Cast device."""
-    server = None
-    used_cached = False
+    """Play audio file from AUDIO_DIR on Google Cast device."""
+    # Verify audio file exists and has content, with a single stat
     try:
-        # Verify audio file exists and has content
-        if not audio_path.exists():
-            logger.error(f"Audio file not found: {audio_path}")
-            return False
         file_size = audio_path.stat().st_size
-        if file_size < 100:
-            logger.error(f"Audio file too small: {file_size} bytes")
-            return False
-        logger.info(f"Audio file: {audio_path.name} ({file_size} bytes)")
+    except FileNotFoundError:
+        logger.error("Audio file not found: %s", audio_path)
+        return False
+    if file_size < 100:
+        logger.error("Audio file too small: %s bytes", file_size)
+        return False
+    logger.info("Audio file: %s (%s bytes)", audio_path.name, file_size)
+
+    # The long-lived audio server hands the file to the device
+    return play_url_on_googlecast(
+        device,
+        audio_server.url_for(audio_path),
+        audio_mime_type(audio_path.name),
+    )
 
+
+def play_url_on_googlecast(device: Device, url: str, content_type: str) -> bool:
+    """Have a Google Cast device fetch and play audio from the audio server."""
+    try:
         # Try to use cached connection first
         cast = cast_connection.get_cast()
         if cast and cast_connection.device_id == device.id:
             logger.info("Using cached connection")
-            used_cached = True
         else:
             # No cached connection, establish new one
             if not cast_connection.connect(device):
@@ -171,125 +412,101 @@ def play_on_googlecast(device: Device, audio_path: Path) -> bool:
                 logger.error("No cast device after connect")
                 return False
 
-        # Start HTTP server to serve the audio
-        server = AudioServer(audio_path.parent)
-        port = server.start()
-
-        local_ip = get_local_ip()
-        url = f"http://{local_ip}:{port}/{audio_path.name}"
-        logger.info(f"Serving audio at {url}")
+        logger.info("Serving audio at %s", url)
 
         mc = cast.media_controller
 
-        # If not cached, give more time for connection to stabilize
-        if not used_cached:
-            time.sleep(1)
-
         # Play media
+        listener = cast_connection.listener
+        listener.reset()
         logger.info("Sending play_media command...")
-        mc.play_media(url, "audio/mpeg")
-
-        # Wait for media to be accepted
-        time.sleep(0.5)
-
-        # Check if already finished (very short audio)
-        state = mc.status.player_state if mc.status else None
-        idle_reason = mc.status.idle_reason if mc.status else None
-        logger.info(f"Initial state: {state}, idle_reason: {idle_reason}")
-
-        if state == "IDLE" and idle_reason == "FINISHED":
-            logger.info("Playback completed quickly (very short audio)")
-            return True
-
-        # Try to wait for active state (but don't retry play_media)
-        try:
-            mc.block_until_active(timeout=10)
-        except Exception as e:
-            logger.warning(f"block_until_active failed: {e}")
-            # Check if it finished while waiting
-            state = mc.status.player_state if mc.status else None
-            idle_reason = mc.status.idle_reason if mc.status else None
-            if state == "IDLE" and idle_reason == "FINISHED":
-                logger.info("Playback completed during wait")
-                return True
-
-        # Check media status
-        state = mc.status.player_state if mc.status else None
-        idle_reason = mc.status.idle_reason if mc.status else None
-        logger.info(f"Player state: {state}, idle_reason: {idle_reason}")
-
-        # If already IDLE with FINISHED reason, playback completed quickly
-        if state == "IDLE":
-            if idle_reason == "FINISHED":
-                logger.info("Playback completed quickly (short audio)")
-                return True
-            elif idle_reason and idle_reason not in ("FINISHED", "INTERRUPTED"):
-                logger.error(f"Playback failed, reason: {idle_reason}")
-                return False
-
-        # Wait for playback to complete with timeout
-        timeout = 60  # Max 1 minute for normal audio
-        start_time = time.time()
-        played = False
-
-        while time.time() - start_time < timeout:
-            state = mc.status.player_state if mc.status else None
-            idle_reason = mc.status.idle_reason if mc.status else None
-
-            if state == "PLAYING":
-                played = True
-            elif state == "IDLE":
-                if played or idle_reason == "FINISHED":
-                    # Finished playing successfully
-                    break
-                elif idle_reason and idle_reason not in ("FINISHED", "INTERRUPTED"):
-                    logger.error(f"Playback error: {idle_reason}")
-                    return False
-                elif time.time() - start_time > 5:
-                    # Short audio likely finished, don't wait forever
-                    logger.info("Short audio likely finished")
-                    break
-            time.sleep(0.3)
+        mc.play_media(url, content_type)
+
+        # Sleep until the device pushes a status change instead of polling
+        if not listener.finished.is_set() and not listener.started.wait(
+            timeout=PLAYBACK_START_TIMEOUT
+        ):
+            logger.info(
+                "Playback not started yet, idle_reason: %s", listener.idle_reason
+            )
+        if not listener.finished.wait(timeout=PLAYBACK_TIMEOUT):
+            logger.warning("Playback still running after %ss", PLAYBACK_TIMEOUT)
+
+        idle_reason = listener.idle_reason
+        if idle_reason and idle_reason not in ("FINISHED", "INTERRUPTED"):
+            logger.error("Playback error: %s", idle_reason)
+            return False
 
         logger.info("Playback finished successfully")
         return True
 
     except Exception as e:
-        logger.error(f"Error playing on Google Cast: {e}", exc_info=True)
+        logger.error("Error playing on Google Cast: %s", e, exc_info=True)
         return False
-    finally:
-        if server:
-            try:
-                server.stop()
-            except Exception:
-                pass
 
 
-def play_on_macos_say(audio_path: Path) -> bool:
-    """Play audio using macOS afplay command."""
-    try:
-        subprocess.run(["afplay", str(audio_path)], check=True)
-        return True
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Error playing audio with afplay: {e}")
+async def run_command(*args: str) -> bool:
+    """Run a command without blocking the event loop; True if it succeeded."""
+    proc = await asyncio.create_subprocess_exec(
+        *args, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+    )
+    _, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        logger.error("%s failed: %s", args[0], stderr.decode(errors="replace").strip())
         return False
+    return True
 
 
-def speak_text_macos(text: str) -> bool:
-    """Speak text using macOS say command."""
-    try:
-        subprocess.run(["say", text], check=True)
+async def play_on_macos_say(audio_path: Path) -> bool:
+    """Play audio using macOS afplay command."""
+    if await run_command("afplay", str(audio_path)):
         return True
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Error with macOS say: {e}")
+    if audio_path.suffix == ".mp3":
         return False
 
+    # afplay can't decode some formats (e.g. OGG/Opus); retry as MP3
+    logger.info("afplay failed for %s, converting to MP3", audio_path.name)
+    mp3_path = await convert_to_mp3(audio_path)
+    if not mp3_path:
+        return False
+    try:
+        return await run_command("afplay", str(mp3_path))
+    finally:
+        mp3_path.unlink(missing_ok=True)
+
+
+async def speak_text_macos(text: str, voice: str | None = None) -> bool:
+    """Speak text using macOS say command, in the system voice by default."""
+    if voice:
+        return await run_command("say", *say_voice_args(voice), text)
+    return await run_command("say", text)
+
 
 async def play_audio(device: Device, audio_path: Path) -> bool:
     """Play audio on the specified device."""
-    loop = asyncio.get_event_loop()
     if device.device_type == DeviceType.MACOS_SAY:
-        return await loop.run_in_executor(None, play_on_macos_say, audio_path)
+        return await play_on_macos_say(audio_path)
     elif device.device_type == DeviceType.GOOGLE_CAST:
-        return await loop.run_in_executor(None, play_on_googlecast, device, audio_path)
+        loop = asyncio.get_running_loop()
+        success = await loop.run_in_executor(
+            CAST_EXECUTOR, play_on_googlecast, device, audio_path
+        )
+        remember_cast_location(device)
+        return success
     return False
+
+
+async def play_mp3_bytes_on_googlecast(device: Device, data: bytes) -> bool:
+    """Play an in-memory MP3 on a Google Cast device."""
+    # Cast devices fetch it straight from memory; nothing touches the disk
+    name = f"{uuid.uuid4().hex}.mp3"
+    url = audio_server.hold(name, data)
+    try:
+        loop = asyncio.get_running_loop()
+        success = await loop.run_in_executor(
+            CAST_EXECUTOR, play_url_on_googlecast, device, url, "audio/mpeg"
+        )
+    finally:
+        audio_server.release(name)
+    remember_cast_location(device)
+    return success
@@ -1,35 +1,44 @@
 """Text-to-speech conversion."""
 
+import asyncio
+import functools
+import hashlib
 import logging
+import os
+import re
+import shutil
 import subprocess
+import uuid
 from datetime import datetime
 from pathlib import Path
 
+from .config import AUDIO_DIR, TTS_CACHE_SIZE
+
+try:
+    import lameenc
+except ImportError:  # Encode TTS through an ffmpeg process instead
+    lameenc = None
+
 logger = logging.getLogger(__name__)
 
 
-def get_chinese_time() -> str:
-    """Get current time in Chinese format."""
-    now = datetime.now()
-    hour = now.hour
-    minute = now.minute
-
-    # Determine period of day
-    if 5 <= hour < 12:
-        period = "早上"
-    elif 12 <= hour < 13:
-        period = "中午"
-    elif 13 <= hour < 18:
-        period = "下午"
-    elif 18 <= hour < 22:
-        period = "晚上"
-    else:
-        period = "深夜"
+# Period of day and 12-hour clock hour, indexed by hour (0-23)
+PERIOD_BY_HOUR = (
+    ("深夜",) * 5
+    + ("早上",) * 7
+    + ("中午",)
+    + ("下午",) * 5
+    + ("晚上",) * 4
+    + ("深夜",) * 2
+)
+DISPLAY_HOUR = tuple((h - 1) % 12 + 1 for h in range(24))
 
-    # Convert to 12-hour format for display
-    display_hour = hour if hour <= 12 else hour - 12
-    if display_hour == 0:
-        display_hour = 12
+
+@functools.cache
+def format_chinese_time(hour: int, minute: int) -> str:
+    """Format a time of day in Chinese (cached; there are only 1440)."""
+    period = PERIOD_BY_HOUR[hour]
+    display_hour = DISPLAY_HOUR[hour]
 
     if minute == 0:
         return f"現在時間是{period}{display_hour}點整"
@@ -37,80 +46,265 @@ def get_chinese_time() -> str:
         return f"現在時間是{period}{display_hour}點{minute}分"
 
 
+def get_chinese_time() -> str:
+    """Get current time in Chinese format."""
+    now = datetime.now()
+    return format_chinese_time(now.hour, now.minute)
+
+
+# Variables that can appear in text, e.g. $TIME, and what they expand to
+VARIABLES = {
+    "TIME": get_chinese_time,
+}
+VARIABLE_PATTERN = re.compile(r"\$(" + "|".join(VARIABLES) + ")")
+
+
 def expand_variables(text: str) -> str:
-    """Expand variables like $TIME in text."""
-    if "$TIME" in text:
-        text = text.replace("$TIME", get_chinese_time())
-    return text
+    """Expand variables like $TIME in text, in a single pass."""
+    return VARIABLE_PATTERN.sub(lambda m: VARIABLES[m.group(1)](), text)
 
 
-def text_to_mp3(text: str, output_path: Path, voice: str = "Mei-Jia") -> bool:
-    """Convert text to MP3 using macOS say command.
+@functools.cache
+def get_ffmpeg_path() -> str:
+    """Get the ffmpeg binary (use full path to avoid alias issues).
 
-    Voices: Mei-Jia (Chinese), Samantha (English), etc.
-    List voices with: say -v '?'
+    Resolved once, so each conversion skips the PATH lookup.
     """
-    aiff_path = output_path.with_suffix(".aiff")
-    try:
-        logger.info(f"TTS: Converting '{text[:30]}...' with voice {voice}")
+    ffmpeg_path = "/opt/homebrew/bin/ffmpeg"
+    if not Path(ffmpeg_path).exists():
+        ffmpeg_path = shutil.which("ffmpeg") or "ffmpeg"  # Fallback to PATH
+    return ffmpeg_path
 
-        # Generate AIFF with say (rate 150 = slower, default ~175-200)
-        result = subprocess.run(
-            ["say", "-v", voice, "-r", "150", "-o", str(aiff_path), text],
-            capture_output=True,
-            text=True,
+
+# Keep ffmpeg quiet: no banner, only errors on stderr
+FFMPEG_QUIET = ["-hide_banner", "-loglevel", "error"]
+
+
+async def run_ffmpeg(*args: str, data: bytes | None = None) -> bool:
+    """Run ffmpeg without blocking the event loop, feeding data on stdin."""
+    stdin = asyncio.subprocess.DEVNULL if data is None else asyncio.subprocess.PIPE
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            get_ffmpeg_path(),
+            *FFMPEG_QUIET,
+            "-y",
+            *args,
+            stdin=stdin,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
         )
-        if result.returncode != 0:
-            logger.error(f"say command failed: {result.stderr}")
-            return False
+    except FileNotFoundError:
+        logger.error("FFmpeg not found")
+        return False
+    _, stderr = await proc.communicate(data)
+    if proc.returncode != 0:
+        logger.error("FFmpeg conversion failed: %s", stderr.decode(errors="replace"))
+        return False
+    return True
+
+
+async def convert_to_mp3(input_path: Path) -> Path | None:
+    """Convert an audio file to MP3 next to the original, or None on failure."""
+    mp3_path = input_path.with_suffix(".mp3")
+    if await run_ffmpeg("-i", str(input_path), "-acodec", "libmp3lame", str(mp3_path)):
+        return mp3_path
+    mp3_path.unlink(missing_ok=True)
+    return None
+
+
+async def bytes_to_mp3(data: bytes, output_path: Path) -> bool:
+    """Encode in-memory audio to MP3, feeding it to ffmpeg on stdin."""
+    if await run_ffmpeg(
+        "-i", "pipe:0", "-acodec", "libmp3lame", str(output_path), data=data
+    ):
+        return True
+    output_path.unlink(missing_ok=True)
+    return False
+
+
+# PCM format requested from say; lameenc is configured to match
+SAY_SAMPLE_RATE = 22050
+# say produces mono speech, which stays clear at 64 kbps; half the bytes of
+# 128 kbps means Cast devices fetch it and start playing sooner
+MP3_BIT_RATE = 64
+
+# Default voice: Mei-Jia (Chinese), Samantha (English), etc.
+TTS_VOICE = "Mei-Jia"
+
+
+def say_voice_args(voice: str) -> list[str]:
+    """Get the say options selecting the voice and speaking rate."""
+    # Rate 150 = slower, default ~175-200
+    return ["-v", voice, "-r", "150"]
 
-        if not aiff_path.exists():
-            logger.error("AIFF file not created")
-            return False
-        logger.info(f"AIFF created: {aiff_path.stat().st_size} bytes")
 
-        # Convert to MP3 with ffmpeg (use full path to avoid alias issues)
-        ffmpeg_path = "/opt/homebrew/bin/ffmpeg"
-        if not Path(ffmpeg_path).exists():
-            ffmpeg_path = "ffmpeg"  # Fallback to PATH
+def say_command(text: str, voice: str) -> list[str]:
+    """Build the say command that writes WAVE audio to stdout."""
+    return [
+        "say",
+        *say_voice_args(voice),
+        "--file-format=WAVE",
+        f"--data-format=LEI16@{SAY_SAMPLE_RATE}",
+        "-o",
+        "/dev/stdout",
+        text,
+    ]
 
-        result = subprocess.run(
+
+def wav_pcm(data: bytes) -> bytes:
+    """Get the samples from streamed WAVE data.
+
+    say can't seek back to fill in chunk sizes when writing to a pipe, so
+    everything after the data chunk header is taken as samples.
+    """
+    offset = 12  # Skip the RIFF header
+    while offset + 8 <= len(data):
+        chunk_id = data[offset : offset + 4]
+        size = int.from_bytes(data[offset + 4 : offset + 8], "little")
+        if chunk_id == b"data":
+            return data[offset + 8 :]
+        offset += 8 + size + (size & 1)
+    return b""
+
+
+def encode_mp3(pcm: bytes) -> bytes:
+    """Encode mono 16-bit PCM from say to MP3 in-process."""
+    encoder = lameenc.Encoder()
+    encoder.set_bit_rate(MP3_BIT_RATE)
+    encoder.set_in_sample_rate(SAY_SAMPLE_RATE)
+    encoder.set_channels(1)
+    encoder.set_quality(2)
+    return encoder.encode(pcm) + encoder.flush()
+
+
+def say_to_mp3_lame(text: str, voice: str) -> bytes | None:
+    """Run say and encode its output with lameenc, skipping ffmpeg."""
+    say_proc = subprocess.run(say_command(text, voice), capture_output=True)
+    if say_proc.returncode != 0:
+        logger.error("say command failed: %s", say_proc.stderr.decode(errors="replace"))
+        return None
+    return bytes(encode_mp3(wav_pcm(say_proc.stdout)))
+
+
+def say_to_mp3_ffmpeg(text: str, voice: str) -> bytes | None:
+    """Stream say's output through ffmpeg, without an intermediate file."""
+    say_proc = subprocess.Popen(
+        say_command(text, voice),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    try:
+        ffmpeg_proc = subprocess.Popen(
             [
-                ffmpeg_path,
-                "-y",
+                get_ffmpeg_path(),
+                *FFMPEG_QUIET,
+                "-f",
+                "wav",
                 "-i",
-                str(aiff_path),
+                "pipe:0",
                 "-acodec",
                 "libmp3lame",
                 "-b:a",
-                "128k",
-                str(output_path),
+                f"{MP3_BIT_RATE}k",
+                "-f",
+                "mp3",
+                "pipe:1",
             ],
-            capture_output=True,
-            text=True,
+            stdin=say_proc.stdout,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
         )
-        if result.returncode != 0:
-            logger.error(f"ffmpeg failed: {result.stderr}")
-            return False
+    finally:
+        # ffmpeg owns the read end now; closing ours lets say see EPIPE
+        say_proc.stdout.close()
 
-        aiff_path.unlink(missing_ok=True)
+    mp3_data, ffmpeg_err = ffmpeg_proc.communicate()
+    say_err = say_proc.stderr.read()
+    say_proc.stderr.close()
+    say_proc.wait()
 
-        if not output_path.exists():
-            logger.error("MP3 file not created")
-            return False
+    if say_proc.returncode != 0:
+        logger.error("say command failed: %s", say_err.decode(errors="replace"))
+        return None
+    if ffmpeg_proc.returncode != 0:
+        logger.error("ffmpeg failed: %s", ffmpeg_err.decode(errors="replace"))
+        return None
+    return mp3_data
 
-        mp3_size = output_path.stat().st_size
-        logger.info(f"MP3 created: {mp3_size} bytes")
 
-        if mp3_size < 100:
-            logger.error("MP3 file too small")
-            return False
+def text_to_mp3_bytes(text: str, voice: str = TTS_VOICE) -> bytes | None:
+    """Convert text to MP3 in memory using macOS say command.
 
-        return True
-    except subprocess.CalledProcessError as e:
-        logger.error(f"TTS conversion failed: {e}")
-        aiff_path.unlink(missing_ok=True)
-        return False
+    List voices with: say -v '?'
+    """
+    try:
+        logger.info("TTS: Converting '%s...' with voice %s", text[:30], voice)
+
+        # lameenc encodes in-process, saving an ffmpeg start-up per phrase
+        convert = say_to_mp3_lame if lameenc else say_to_mp3_ffmpeg
+        mp3_data = convert(text, voice)
     except FileNotFoundError as e:
-        logger.error(f"Required tool not found: {e}")
+        logger.error("Required tool not found: %s", e)
+        return None
+    if mp3_data is None:
+        return None
+
+    logger.info("MP3 created: %s bytes", len(mp3_data))
+    if len(mp3_data) < 100:
+        logger.error("MP3 file too small")
+        return None
+    return mp3_data
+
+
+def text_to_mp3(text: str, output_path: Path, voice: str = TTS_VOICE) -> bool:
+    """Convert text to an MP3 file using macOS say command."""
+    mp3_data = text_to_mp3_bytes(text, voice)
+    if mp3_data is None:
         return False
+    output_path.write_bytes(mp3_data)
+    return True
+
+
+# Cached phrases in AUDIO_DIR are named tts_<hash>.mp3
+TTS_CACHE_PREFIX = "tts_"
+
+
+def tts_cache_path(text: str, voice: str = TTS_VOICE) -> Path:
+    """Get the cache file for a phrase, inside AUDIO_DIR so it can be served."""
+    key = hashlib.blake2b(f"{voice}|{text}".encode(), digest_size=16).hexdigest()
+    return AUDIO_DIR / f"{TTS_CACHE_PREFIX}{key}.mp3"
+
+
+def prune_tts_cache() -> None:
+    """Delete the least recently used phrases beyond TTS_CACHE_SIZE."""
+    try:
+        files = sorted(
+            AUDIO_DIR.glob(f"{TTS_CACHE_PREFIX}*.mp3"),
+            key=lambda p: p.stat().st_mtime,
+            reverse=True,
+        )
+    except FileNotFoundError:
+        return  # Another worker is pruning at the same time
+    for path in files[TTS_CACHE_SIZE:]:
+        path.unlink(missing_ok=True)
+
+
+def cached_text_to_mp3(text: str, voice: str = TTS_VOICE) -> Path | None:
+    """Get an MP3 for text, reusing an earlier one for the same phrase."""
+    cache_path = tts_cache_path(text, voice)
+    try:
+        if cache_path.stat().st_size >= 100:
+            logger.info("TTS: Cache hit for '%s...'", text[:30])
+            cache_path.touch()  # Mark as recently used
+            return cache_path
+    except FileNotFoundError:
+        pass  # Not cached yet
+
+    # Write to a unique name first so concurrent requests never see a partial file
+    tmp_path = AUDIO_DIR / f"{uuid.uuid4().hex}.mp3"
+    if not text_to_mp3(text, tmp_path, voice):
+        tmp_path.unlink(missing_ok=True)
+        return None
+    os.replace(tmp_path, cache_path)
+    prune_tts_cache()
+    return cache_path
@@ -1,18 +1,28 @@
 """Utility functions."""
 
+import functools
 import logging
-import os
 import socket
+import sys
+import threading
+import time
+from uuid import UUID
 
-import pychromecast
+import zeroconf
+from pychromecast.discovery import CastBrowser, SimpleCastListener
+from pychromecast.models import CastInfo
 
 from .models import Device, DeviceType
 
 logger = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=1)
 def get_local_ip() -> str:
-    """Get local IP address for serving audio to Chromecast."""
+    """Get local IP address for serving audio to Chromecast.
+
+    The result is cached; call get_local_ip.cache_clear() after a network change.
+    """
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
         s.connect(("8.8.8.8", 80))
@@ -21,26 +31,111 @@ def get_local_ip() -> str:
         s.close()
 
 
+class CastDiscovery:
+    """Keep a Google Cast browser running and track discovered devices."""
+
+    def __init__(self):
+        self.zconf: zeroconf.Zeroconf | None = None
+        self.browser: CastBrowser | None = None
+        self.known_casts: dict[UUID, CastInfo] = {}
+        self.started_at = 0.0
+        self._changed = threading.Condition()
+
+    def start(self, known_hosts: list[str] | None = None):
+        """Start background discovery.
+
+        known_hosts are polled directly as well as found through mDNS.
+        """
+        if self.browser:
+            return
+        logger.info("Starting Google Cast discovery")
+        self.zconf = zeroconf.Zeroconf()
+        self.browser = CastBrowser(
+            SimpleCastListener(self._add_cast, self._remove_cast, self._add_cast),
+            zeroconf_instance=self.zconf,
+            known_hosts=known_hosts,
+        )
+        self.browser.start_discovery()
+        self.started_at = time.monotonic()
+
+    def add_known_host(self, host: str):
+        """Poll a device's address directly instead of waiting for mDNS."""
+        self.start()
+        self.browser.host_browser.add_hosts([host])
+
+    def stop(self):
+        """Stop background discovery."""
+        if self.browser:
+            self.browser.stop_discovery()
+            self.browser = None
+        if self.zconf:
+            # The browser leaves a Zeroconf it was given open
+            self.zconf.close()
+            self.zconf = None
+        with self._changed:
+            self.known_casts.clear()
+
+    def _add_cast(self, uuid: UUID, service: str):
+        """Record a new or updated device (called from the zeroconf thread)."""
+        browser = self.browser
+        if not browser:
+            return  # stop() ran while this callback was in flight
+        with self._changed:
+            self.known_casts[uuid] = browser.devices[uuid]
+            self._changed.notify_all()
+
+    def _remove_cast(self, uuid: UUID, service: str, cast_info: CastInfo):
+        """Forget a device that left the network."""
+        with self._changed:
+            self.known_casts.pop(uuid, None)
+
+    def get_devices(self, timeout: float = 10) -> list[Device]:
+        """Get known devices once the discovery window has passed.
+
+        Devices (speaker groups especially) keep answering for a while, so
+        the rest of the timeout since start() is waited out rather than
+        returning on the first one; once it has passed, calls return at once.
+        """
+        self.start()
+        remaining = timeout - (time.monotonic() - self.started_at)
+        if remaining > 0:
+            time.sleep(remaining)
+        with self._changed:
+            cast_infos = list(self.known_casts.values())
+        return [
+            Device(
+                id=str(info.uuid),
+                name=info.friendly_name,
+                address=info.host,
+                device_type=DeviceType.GOOGLE_CAST,
+                port=info.port,
+            )
+            for info in cast_infos
+        ]
+
+    def get_cast_info(self, device_id: str, timeout: float = 10) -> CastInfo | None:
+        """Get cast info for a device, waiting up to timeout for it to appear."""
+        self.start()
+        uuid = UUID(device_id)
+        with self._changed:
+            self._changed.wait_for(lambda: uuid in self.known_casts, timeout)
+            return self.known_casts.get(uuid)
+
+
+# Global cast discovery instance
+cast_discovery = CastDiscovery()
+
+
 def discover_googlecast_devices(timeout: int = 10) -> list[Device]:
     """Discover Google Cast devices on the network."""
     devices = []
     try:
-        logger.info(f"Scanning for Google Cast devices (timeout={timeout}s)...")
-        chromecasts, browser = pychromecast.get_chromecasts(timeout=timeout)
-        logger.info(f"Found {len(chromecasts)} Google Cast device(s)")
-        for cc in chromecasts:
-            logger.info(f"  - {cc.cast_info.friendly_name} @ {cc.cast_info.host}")
-            devices.append(
-                Device(
-                    id=str(cc.uuid),
-                    name=cc.cast_info.friendly_name,
-                    address=cc.cast_info.host,
-                    device_type=DeviceType.GOOGLE_CAST,
-                )
-            )
-        browser.stop_discovery()
+        devices = cast_discovery.get_devices(timeout)
+        logger.info("Found %s Google Cast device(s)", len(devices))
+        for device in devices:
+            logger.info("  - %s @ %s", device.name, device.address)
     except Exception as e:
-        logger.error(f"Error discovering Google Cast devices: {e}")
+        logger.error("Error discovering Google Cast devices: %s", e)
     return devices
 
 
@@ -58,8 +153,8 @@ def discover_all_devices(timeout: int = 10) -> list[Device]:
     """Discover all available playback devices."""
     devices = []
 
-    # Add macOS say if on Darwin
-    if os.uname().sysname == "Darwin":
+    # Add macOS say if on Darwin; it is known at once, unlike Cast devices
+    if sys.platform == "darwin":
         devices.append(get_macos_say_device())
 
     # Add Google Cast devices